@@ -0,0 +1,1045 @@
+"""Compile a subset of Python source to register code.
+
+A pure-Python prototype of the register compiler, derived from Darius
+Bacon's `tailbiter' and re-targeted at the register instruction set.  It
+is useful for trying out changes to the instruction encoding and code
+layout without touching Python/compile.c, which remains the real
+compiler.
+
+Only a subset of the language is compiled: no generators, no
+try/except/finally, no keyword or star arguments, and immediates must
+fit in their un-widened (one byte) encoding.
+
+Usage: ./python Tools/scripts/compile3.py file.py
+"""
+
+import ast
+import collections
+import functools
+import hashlib
+import marshal
+import operator
+import os
+import struct
+import sys
+import types
+
+import dis
+
+# Registers between the caller's and the callee's frame (ceval_meta.h).
+FRAME_EXTRA = 4
+
+VERBOSE = bool(os.environ.get('COMPILE3_VERBOSE'))
+
+# Py_LT .. Py_GE, the first immediate of COMPARE_OP.
+PY_LT, PY_LE, PY_EQ, PY_NE, PY_GT, PY_GE = range(6)
+
+
+def load_file(filename, module_name):
+    f = open(filename)
+    source = f.read()
+    f.close()
+    if VERBOSE:
+        print('compiling', filename)
+    path = cache_path(filename, module_name, source)
+    cached = cache_load(path)
+    if cached is None:
+        t = ast.parse(source)
+        cached = (ast.get_docstring(t),
+                  code_for_module(module_name, filename, t))
+        cache_store(path, cached)
+    return run_module(module_name, *cached)
+
+def module_from_ast(module_name, filename, t):
+    code = code_for_module(module_name, filename, t)
+    return run_module(module_name, ast.get_docstring(t), code)
+
+def run_module(module_name, docstring, code):
+    module = types.ModuleType(module_name, docstring)
+    exec(code, module.__dict__)
+    return module
+
+def cache_path(filename, module_name, source):
+    # Keyed by content rather than mtime, so a touched-but-unchanged file
+    # still hits.  The filename and module name are part of the key too:
+    # they are baked into the code object, and two identical sources
+    # under different paths must not serve each other's entry.
+    key = '\0'.join((filename, module_name, source))
+    digest = hashlib.blake2b(key.encode()).hexdigest()
+    return os.path.join(os.path.expanduser('~/.cache/compile3'),
+                        digest + '.marshal')
+
+def cache_load(path):
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    with f:
+        try:
+            return marshal.loads(f.read())
+        except (EOFError, ValueError, TypeError):
+            return None         # truncated or stale entry; recompile
+
+def cache_store(path, cached):
+    # Best effort: an unwritable cache directory just means recompiling
+    # next time.
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, 'wb')
+    except OSError:
+        return
+    with f:
+        f.write(marshal.dumps(cached))
+
+def code_for_module(module_name, filename, t):
+    t, scope = desugar_and_scope(t)
+    return CodeGen(filename, scope).compile_module(t, module_name)
+
+def desugar_and_scope(t):
+    single_pass = DesugarAndScope(t)
+    t = ast.fix_missing_locations(single_pass.visit(t))
+    single_pass.scope.analyze(set())
+    return t, single_pass.scope
+
+
+def assemble(assembly):
+    out = bytearray(assembly.length)
+    assembly.resolve(0)
+    assembly.encode(0, out)
+    return bytes(out)
+
+def make_lnotab(assembly):
+    # Two passes over the (offset, line) events: bound the row count, then
+    # write rows into a preallocated buffer by index.  The buffer starts
+    # zeroed, so a run of filler rows only needs its nonzero column
+    # stored -- one strided slice assignment per run instead of appends.
+    events = assembly.line_nos(0)
+    if not events:
+        return 1, b''
+    firstlineno = events[0][1]
+    rows = 0
+    byte, line = 0, firstlineno
+    for next_byte, next_line in events:
+        if line < next_line:
+            rows += ((next_byte - byte) // 127
+                     + (next_line - line) // 127 + 1)
+            byte, line = next_byte, next_line
+    out = bytearray(2 * rows)
+    n = 0
+    byte, line = 0, firstlineno
+    for next_byte, next_line in events:
+        if line < next_line:
+            # Decompose the deltas into 127-sized filler rows
+            # arithmetically rather than one row at a time.
+            fill_bytes, rest_byte = divmod(next_byte - byte, 127)
+            if fill_bytes and rest_byte == 0:
+                fill_bytes, rest_byte = fill_bytes - 1, 127
+            if fill_bytes:
+                out[n:n + 2 * fill_bytes:2] = b'\x7f' * fill_bytes
+                n += 2 * fill_bytes
+            fill_lines, rest_line = divmod(next_line - line, 127)
+            if fill_lines and rest_line == 0:
+                fill_lines, rest_line = fill_lines - 1, 127
+            if fill_lines:
+                out[n], out[n + 1] = rest_byte, 127
+                n += 2
+                fill_lines -= 1
+                if fill_lines:
+                    out[n + 1:n + 2 * fill_lines:2] = b'\x7f' * fill_lines
+                    n += 2 * fill_lines
+                rest_byte = 0
+            out[n], out[n + 1] = rest_byte, rest_line
+            n += 2
+            byte, line = next_byte, next_line
+    return firstlineno, bytes(memoryview(out)[:n])
+
+class Assembly:
+    __slots__ = ()
+    length = 0
+    def __add__(self, other):
+        return FlatAssembly(self._as_list() + other._as_list())
+    def _as_list(self):
+        return [self]
+    def encode(self, start, out):
+        pass
+    def line_nos(self, start):
+        return ()
+
+class Label(Assembly):
+    __slots__ = ('offset',)
+
+class SetLineNo(Assembly):
+    __slots__ = ('line',)
+    def __init__(self, line):
+        self.line = line
+    def line_nos(self, start):
+        return ((start, self.line),)
+
+@functools.lru_cache(maxsize=None)
+def setlineno(line):
+    return SetLineNo(line)
+
+class Instruction(Assembly):
+    __slots__ = ('opcode', 'imm')
+
+    @property
+    def length(self):
+        return dis.opcodes[self.opcode].size
+
+    def encode(self, start, out):
+        imm = self.imm
+        if _is_jump[self.opcode]:
+            imm = imm[:-1] + ((imm[-1].offset - start) & 0xFFFF,)
+        _pack_into[self.opcode](out, start, self.opcode, *imm)
+
+# Per-opcode tables, so the encoder asks a list instead of chasing
+# attributes through dis on every instruction.  _pack_into holds one
+# precompiled packer per opcode, built from its immediate layout;
+# packing an instruction is then a single C call instead of a Python
+# loop over the immediate formats.
+_is_jump = [False] * 256
+_pack_into = [None] * 256
+for _bytecode in dis.bytecodes:
+    _is_jump[_bytecode.opcode] = _bytecode.is_jump()
+    _fmt = '<B' + ''.join('H' if _imm in ('jump', 'imm16') else 'B'
+                          for _imm in _bytecode.imm)
+    _pack_into[_bytecode.opcode] = struct.Struct(_fmt).pack_into
+del _bytecode, _fmt
+
+class FlatAssembly(Assembly):
+    __slots__ = ('parts', 'length')
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = sum(part.length for part in parts)
+    def _as_list(self):
+        return self.parts
+    def __iadd__(self, other):
+        # In-place append for accumulation loops; the caller must own
+        # self (i.e. not hand out no_op or another shared assembly).
+        self.parts.extend(other._as_list())
+        self.length += other.length
+        return self
+    def resolve(self, start):
+        for part in self.parts:
+            if type(part) is Label:
+                part.offset = start
+            else:
+                start += part.length
+    def encode(self, start, out):
+        for part in self.parts:
+            part.encode(start, out)
+            start += part.length
+    def line_nos(self, start):
+        nos = []
+        for part in self.parts:
+            nos.extend(part.line_nos(start))
+            start += part.length
+        return nos
+
+no_op = FlatAssembly([])
+
+def peephole(parts):
+    # Jump cleanup on the flat part list, before offsets are assigned:
+    # shortcut jumps whose target is itself an unconditional JUMP, and
+    # drop a JUMP to the instruction that follows it anyway.  An If with
+    # no else-branch, for instance, emits a JUMP over an empty block.
+    # Repeats until nothing changes, since dropping a jump can bring
+    # another jump next to its target.
+    jump_op = dis.opmap['JUMP']
+    changed = True
+    while changed:
+        changed = False
+        # Where in parts the instruction each label precedes sits
+        # (ignoring other labels and line markers in between).  Indices,
+        # not the instructions themselves: zero-immediate opcodes are
+        # shared singletons, so identity can't tell two sites apart.
+        following = {}
+        pending = []
+        for i, part in enumerate(parts):
+            if type(part) is Label:
+                pending.append(part)
+            elif type(part) is Instruction:
+                for label in pending:
+                    following[label] = i
+                pending = []
+        out = []
+        n = len(parts)
+        for i, part in enumerate(parts):
+            if type(part) is Instruction and _is_jump[part.opcode]:
+                label = part.imm[-1]
+                # Follow a chain of unconditional JUMPs to its end; a
+                # cycle would be an infinite loop, leave those alone.
+                seen = {label}
+                final = label
+                while True:
+                    index = following.get(final)
+                    dest = parts[index] if index is not None else None
+                    if not (type(dest) is Instruction
+                            and dest.opcode == jump_op):
+                        break
+                    target = dest.imm[-1]
+                    if target in seen:
+                        final = label
+                        break
+                    seen.add(target)
+                    final = target
+                if final is not label:
+                    part.imm = part.imm[:-1] + (final,)
+                    changed = True
+                if part.opcode == jump_op:
+                    j = i + 1
+                    while j < n and type(parts[j]) is not Instruction:
+                        j += 1
+                    if j == following.get(final):
+                        changed = True
+                        continue    # falls through to its target anyway
+            out.append(part)
+        parts = out
+    return parts
+
+def instruction(opcode, imm):
+    inst = Instruction.__new__(Instruction)
+    inst.opcode = opcode
+    inst.imm = imm
+    return inst
+
+def denotation(bytecode):
+    if not bytecode.imm:
+        return instruction(bytecode.opcode, ())
+    # exec a bespoke fixed-arity factory per opcode: the immediates land
+    # straight in a tuple literal, with no *args packing and no
+    # __init__ frame.
+    args = ', '.join('imm%d' % i for i in range(len(bytecode.imm)))
+    source = ('def %s(%s, _new=Instruction.__new__):\n'
+              '    inst = _new(Instruction)\n'
+              '    inst.opcode = %d\n'
+              '    inst.imm = (%s,)\n'
+              '    return inst\n'
+              % (bytecode.name, args, bytecode.opcode, args))
+    namespace = {'Instruction': Instruction}
+    exec(source, namespace)
+    return namespace[bytecode.name]
+
+op = type('op', (), {bytecode.name: denotation(bytecode)
+                     for bytecode in dis.bytecodes})
+
+
+class Interner(dict):
+    # Maps each key to a dense index assigned on first lookup.  A plain
+    # __missing__ avoids the closure call that defaultdict's factory costs
+    # on every miss, and hits stay on the fast dict path.
+    __slots__ = ()
+    def __missing__(self, key):
+        index = self[key] = len(self)
+        return index
+
+def collect(table):
+    return tuple(sorted(table, key=table.get))
+
+class constants(collections.defaultdict):
+    # Two-level table: type, then value.  Keying the outer level by the
+    # type keeps 1, 1.0 and True distinct without building a
+    # (key, type(key)) tuple on every constant lookup.
+    def __init__(self):
+        super().__init__(dict)
+        self.next_index = 0
+    def __getitem__(self, key):
+        inner = super().__getitem__(type(key))
+        index = inner.get(key)
+        if index is None:
+            index = inner[key] = self.next_index
+            self.next_index += 1
+        return index
+    def collect(self):
+        collected = [None] * self.next_index
+        for inner in self.values():
+            for key, index in inner.items():
+                collected[index] = key
+        return tuple(collected)
+
+
+class CodeGen(ast.NodeVisitor):
+
+    def __init__(self, filename, scope, parent=None):
+        self.filename = filename
+        self.scope = scope
+        self.parent = parent
+        self.constants = constants()
+        self.varnames = Interner()
+        for name in scope.varnames:
+            self.varnames[name]
+        self.nlocals = len(self.varnames)
+        self.metadata = {}
+        self.next_metaslot = 0
+        # Registers: locals (cell variables included -- the frame setup
+        # turns their registers into cells in place), then captured free
+        # variables, then temporaries.  An un-optimized frame keeps its
+        # locals mapping in regs[0].
+        self.free_base = self.nlocals if scope.optimized else 1
+        base = self.free_base + len(scope.freevars)
+        self.next_register = base
+        self.max_registers = base
+        self.last_line = None
+
+    def compile_module(self, t, name):
+        assembly = self(t.body) + self.load_const(None) + op.RETURN_VALUE
+        return self.make_code(assembly, name, 0)
+
+    def compile_function(self, t):
+        self.load_const(function_docstring(t))
+        assembly = self(t.body) + self.load_const(None) + op.RETURN_VALUE
+        return self.make_code(assembly, t.name, len(t.args.args))
+
+    def compile_class(self, t):
+        assembly = self(t.body) + self.load_const(None) + op.RETURN_VALUE
+        return self.make_code(assembly, t.name, 0)
+
+    def make_code(self, assembly, name, argcount):
+        if VERBOSE:
+            print('made code', name)
+        assert self.max_registers < 256, "WIDE frames not supported"
+        # Metaslots are negative and encoded as a signed byte, so -128
+        # is the deepest slot before the immediate wraps positive.
+        assert self.next_metaslot <= 128, "WIDE metadata not supported"
+        assembly = op.FUNC_HEADER(self.max_registers) + assembly
+        assembly = FlatAssembly(peephole(assembly._as_list()))
+        framesize = 0           # unused: the frame size travels in FUNC_HEADER
+        firstlineno, lnotab = make_lnotab(assembly)
+        scope = self.scope
+        flags = (0x01 | 0x02 if scope.optimized else 0x02 if scope.isclass
+                 else 0)        # CO_OPTIMIZED | CO_NEWLOCALS
+        if not scope.derefvars:
+            flags |= 0x40       # CO_NOFREE
+        return types.CodeType(argcount=argcount,
+                              kwonlyargcount=0,
+                              nlocals=self.nlocals,
+                              framesize=framesize,
+                              nmeta=self.next_metaslot,
+                              flags=flags,
+                              code=assemble(assembly),
+                              constants=self.constants.collect(),
+                              varnames=collect(self.varnames),
+                              filename=self.filename,
+                              name=name,
+                              firstlineno=firstlineno,
+                              linetable=lnotab,
+                              freevars=scope.freevars,
+                              cellvars=scope.cellvars,
+                              free2reg=tuple(
+                                  (self.parent.var_register(v),
+                                   self.deref_register(v))
+                                  for v in scope.freevars),
+                              cell2reg=tuple(self.deref_register(v)
+                                             for v in scope.cellvars))
+
+    def metaslot(self, n):
+        slot = -self.next_metaslot - n
+        self.next_metaslot += n
+        return slot & 0xFF     # two's-complement byte; slots are negative
+
+    def global_metaslot(self, name):
+        if name not in self.metadata:
+            self.metadata[name] = self.metaslot(2)
+        return self.metadata[name]
+
+    def allocate_register(self, n=1):
+        reg = self.next_register
+        self.next_register = reg + n
+        if self.next_register > self.max_registers:
+            self.max_registers = self.next_register
+        return reg
+
+    def free_register(self, reg, n=1):
+        assert self.next_register == reg + n
+        self.next_register = reg
+
+    def deref_register(self, name):
+        if name in self.scope.cellvars:
+            return self.varnames[name]
+        return self.free_base + self.scope.freevars.index(name)
+
+    def var_register(self, name):
+        # The register holding the variable (or its cell) in this frame.
+        if name in self.scope.derefvars:
+            return self.deref_register(name)
+        return self.varnames[name]
+
+    def to_register(self, t):
+        reg = self.allocate_register()
+        return self(t) + op.STORE_FAST(reg), reg
+
+    def __call__(self, t):
+        if isinstance(t, list):
+            # Flatten into one parts list as we go, rather than handing
+            # concat an assembly per child to splice afterwards.
+            parts = []
+            for child in t:
+                parts.extend(self(child)._as_list())
+            return FlatAssembly(parts)
+        line = getattr(t, 'lineno', None)
+        if line is None or line == self.last_line:
+            return self.visit(t)
+        self.last_line = line
+        return setlineno(line) + self.visit(t)
+
+    def visit(self, t):
+        # One dict lookup on the node's type, instead of NodeVisitor's
+        # per-call string concatenation and getattr.  The table is built
+        # below, once Function and Class exist.
+        method = self.dispatch.get(type(t))
+        if method is None:
+            return self.generic_visit(t)
+        return method(self, t)
+
+    def generic_visit(self, t):
+        raise NotImplementedError("node not supported: %s" % ast.dump(t))
+
+    def load_const(self, constant):
+        return op.LOAD_CONST(self.constants[constant])
+
+    def visit_Constant(self, t):
+        return self.load_const(t.value)
+
+    def visit_Name(self, t):
+        if isinstance(t.ctx, ast.Load):
+            return self.load(t.id)
+        elif isinstance(t.ctx, ast.Store):
+            return self.store(t.id)
+        else:
+            assert False
+
+    def load(self, name):
+        access = self.scope.access(name)
+        if access == 'fast':
+            return op.LOAD_FAST(self.varnames[name])
+        elif access == 'deref':
+            return op.LOAD_DEREF(self.deref_register(name))
+        elif access == 'name':
+            return op.LOAD_NAME(self.constants[name], self.global_metaslot(name))
+        else:
+            return op.LOAD_GLOBAL(self.constants[name], self.global_metaslot(name))
+
+    def store(self, name):
+        access = self.scope.access(name)
+        if access == 'fast':
+            return op.STORE_FAST(self.varnames[name])
+        elif access == 'deref':
+            return op.STORE_DEREF(self.deref_register(name))
+        elif access == 'name':
+            return op.STORE_NAME(self.constants[name])
+        else:
+            return op.STORE_GLOBAL(self.constants[name])
+
+    def visit_Expr(self, t):
+        return self(t.value) + op.CLEAR_ACC
+
+    def visit_Pass(self, t):
+        return no_op
+
+    def visit_Assign(self, t):
+        [target] = t.targets
+        return self.assign(target, t.value)
+
+    def assign(self, target, value):
+        if isinstance(target, ast.Name):
+            return self(value) + self.store(target.id)
+        elif isinstance(target, ast.Attribute):
+            asm, reg = self.to_register(target.value)
+            asm = (asm + self(value)
+                   + op.STORE_ATTR(reg, self.constants[target.attr])
+                   + op.CLEAR_FAST(reg))
+            self.free_register(reg)
+            return asm
+        elif isinstance(target, ast.Subscript):
+            asm1, container = self.to_register(target.value)
+            asm2, sub = self.to_register(target.slice)
+            asm = (asm1 + asm2 + self(value)
+                   + op.STORE_SUBSCR(container, sub)
+                   + op.CLEAR_FAST(sub) + op.CLEAR_FAST(container))
+            self.free_register(sub)
+            self.free_register(container)
+            return asm
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            n = len(target.elts)
+            base = self.allocate_register(n)
+            asm = self(value) + op.UNPACK(base, n, 0)
+            # UNPACK writes the items in reverse order.
+            for i, elt in enumerate(target.elts):
+                assert isinstance(elt, ast.Name), "nested targets not supported"
+                reg = base + n - 1 - i
+                asm += (op.LOAD_FAST(reg) + op.CLEAR_FAST(reg)
+                        + self.store(elt.id))
+            self.free_register(base, n)
+            return asm
+        else:
+            raise NotImplementedError("assignment target: %s" % ast.dump(target))
+
+    def visit_AugAssign(self, t):
+        assert isinstance(t.target, ast.Name), "augmented target not supported"
+        asm, reg = self.to_register(ast.Name(t.target.id, load))
+        asm = (asm + self(t.value) + self.ops_inplace[type(t.op)](reg)
+               + op.CLEAR_FAST(reg) + self.store(t.target.id))
+        self.free_register(reg)
+        return asm
+
+    def visit_Return(self, t):
+        return ((self(t.value) if t.value else self.load_const(None))
+                + op.RETURN_VALUE)
+
+    def visit_Raise(self, t):
+        assert t.exc is not None and t.cause is None
+        return self(t.exc) + op.RAISE
+
+    def visit_If(self, t):
+        orelse, after = Label(), Label()
+        return (self(t.test) + op.POP_JUMP_IF_FALSE(orelse)
+                + self(t.body) + op.JUMP(after)
+                + orelse + self(t.orelse) + after)
+
+    def visit_IfExp(self, t):
+        orelse, after = Label(), Label()
+        return (self(t.test) + op.POP_JUMP_IF_FALSE(orelse)
+                + self(t.body) + op.JUMP(after)
+                + orelse + self(t.orelse) + after)
+
+    def visit_While(self, t):
+        loop, end = Label(), Label()
+        return (loop + self(t.test) + op.POP_JUMP_IF_FALSE(end)
+                + self(t.body) + op.JUMP(loop) + end)
+
+    def visit_For(self, t):
+        body, next_ = Label(), Label()
+        reg = self.allocate_register()
+        asm = (self(t.iter) + op.GET_ITER(reg) + op.JUMP(next_)
+               + body + self.store_acc(t.target) + self(t.body)
+               + next_ + op.FOR_ITER(reg, body))
+        self.free_register(reg)
+        return asm
+
+    def store_acc(self, target):
+        assert isinstance(target, ast.Name), "loop target not supported"
+        return self.store(target.id)
+
+    def visit_BoolOp(self, t):
+        op_jump = self.ops_bool[type(t.op)]
+        after = Label()
+        parts = []
+        for value in t.values[:-1]:
+            parts.extend(self(value)._as_list())
+            parts.append(op_jump(after))
+        parts.extend(self(t.values[-1])._as_list())
+        parts.append(after)
+        return FlatAssembly(parts)
+
+    ops_bool = {ast.And: op.JUMP_IF_FALSE, ast.Or: op.JUMP_IF_TRUE}
+
+    def visit_UnaryOp(self, t):
+        return self(t.operand) + self.ops1[type(t.op)]
+
+    ops1 = {ast.UAdd: op.UNARY_POSITIVE, ast.USub: op.UNARY_NEGATIVE,
+            ast.Invert: op.UNARY_INVERT, ast.Not: op.UNARY_NOT}
+
+    def visit_BinOp(self, t):
+        asm, reg = self.to_register(t.left)
+        asm = (asm + self(t.right) + self.ops2[type(t.op)](reg)
+               + op.CLEAR_FAST(reg))
+        self.free_register(reg)
+        return asm
+
+    ops2 = {ast.Pow:      op.BINARY_POWER,
+            ast.Mult:     op.BINARY_MULTIPLY,
+            ast.MatMult:  op.BINARY_MATRIX_MULTIPLY,
+            ast.Div:      op.BINARY_TRUE_DIVIDE,
+            ast.FloorDiv: op.BINARY_FLOOR_DIVIDE,
+            ast.Mod:      op.BINARY_MODULO,
+            ast.Add:      op.BINARY_ADD,
+            ast.Sub:      op.BINARY_SUBTRACT,
+            ast.LShift:   op.BINARY_LSHIFT,
+            ast.RShift:   op.BINARY_RSHIFT,
+            ast.BitAnd:   op.BINARY_AND,
+            ast.BitXor:   op.BINARY_XOR,
+            ast.BitOr:    op.BINARY_OR}
+
+    ops_inplace = {ast.Div:      op.INPLACE_TRUE_DIVIDE,
+                   ast.FloorDiv: op.INPLACE_FLOOR_DIVIDE,
+                   ast.Mod:      op.INPLACE_MODULO,
+                   ast.Add:      op.INPLACE_ADD,
+                   ast.Sub:      op.INPLACE_SUBTRACT,
+                   ast.Mult:     op.INPLACE_MULTIPLY,
+                   ast.MatMult:  op.INPLACE_MATRIX_MULTIPLY,
+                   ast.Pow:      op.INPLACE_POWER,
+                   ast.LShift:   op.INPLACE_LSHIFT,
+                   ast.RShift:   op.INPLACE_RSHIFT,
+                   ast.BitAnd:   op.INPLACE_AND,
+                   ast.BitXor:   op.INPLACE_XOR,
+                   ast.BitOr:    op.INPLACE_OR}
+
+    def visit_Compare(self, t):
+        [operand], [cmp] = t.comparators, t.ops
+        asm, reg = self.to_register(t.left)
+        cmp_type = type(cmp)
+        if cmp_type in self.ops_cmp:
+            tail = op.COMPARE_OP(self.ops_cmp[cmp_type], reg)
+        elif cmp_type is ast.Is:
+            tail = op.IS_OP(reg)
+        elif cmp_type is ast.IsNot:
+            tail = op.IS_OP(reg) + op.UNARY_NOT_FAST
+        elif cmp_type is ast.In:
+            tail = op.CONTAINS_OP(reg)
+        else:
+            assert cmp_type is ast.NotIn
+            tail = op.CONTAINS_OP(reg) + op.UNARY_NOT_FAST
+        asm = asm + self(operand) + tail + op.CLEAR_FAST(reg)
+        self.free_register(reg)
+        return asm
+
+    ops_cmp = {ast.Eq: PY_EQ, ast.NotEq: PY_NE, ast.Lt: PY_LT,
+               ast.LtE: PY_LE, ast.Gt: PY_GT, ast.GtE: PY_GE}
+
+    def visit_Call(self, t):
+        assert len(t.args) < 256 and not t.keywords, "call not supported"
+        saved = self.next_register
+        base = saved + FRAME_EXTRA
+        self.next_register = base + len(t.args)
+        if self.next_register > self.max_registers:
+            self.max_registers = self.next_register
+        asm = self(t.func) + op.STORE_FAST(base - 1)
+        for i, arg in enumerate(t.args):
+            asm += self(arg) + op.STORE_FAST(base + i)
+        asm += op.CALL_FUNCTION(base, len(t.args))
+        self.next_register = saved
+        return asm
+
+    def visit_Function(self, t):
+        code = self.sprout(t).compile_function(t)
+        return op.MAKE_FUNCTION(self.constants[code])
+
+    def sprout(self, t):
+        return CodeGen(self.filename, self.scope.children[t], parent=self)
+
+    def visit_Class(self, t):
+        code = self.sprout(t).compile_class(t)
+        saved = self.next_register
+        base = saved + FRAME_EXTRA
+        self.next_register = base + 2 + len(t.bases)
+        if self.next_register > self.max_registers:
+            self.max_registers = self.next_register
+        asm = (op.LOAD_BUILD_CLASS + op.STORE_FAST(base - 1)
+               + op.MAKE_FUNCTION(self.constants[code]) + op.STORE_FAST(base)
+               + self.load_const(t.name) + op.STORE_FAST(base + 1))
+        for i, base_expr in enumerate(t.bases):
+            asm += self(base_expr) + op.STORE_FAST(base + 2 + i)
+        asm += op.CALL_FUNCTION(base, 2 + len(t.bases))
+        self.next_register = saved
+        return asm
+
+    def visit_List(self, t):
+        return self.build(op.BUILD_LIST, t.elts)
+
+    def visit_Tuple(self, t):
+        assert isinstance(t.ctx, ast.Load)
+        return self.build(op.BUILD_TUPLE, t.elts)
+
+    def visit_Set(self, t):
+        return self.build(op.BUILD_SET, t.elts)
+
+    def build(self, build_op, elts):
+        n = len(elts)
+        base = self.allocate_register(n)
+        asm = FlatAssembly([])
+        for i, elt in enumerate(elts):
+            asm += self(elt) + op.STORE_FAST(base + i)
+        asm += build_op(base, n)
+        self.free_register(base, n)
+        return asm
+
+    def visit_Dict(self, t):
+        asm = op.BUILD_MAP(min(len(t.keys), 255))
+        if not t.keys:
+            return asm
+        d = self.allocate_register()
+        asm += op.STORE_FAST(d)
+        for k, v in zip(t.keys, t.values):
+            kasm, kreg = self.to_register(k)
+            asm += (kasm + self(v) + op.STORE_SUBSCR(d, kreg)
+                    + op.CLEAR_FAST(kreg))
+            self.free_register(kreg)
+        asm += op.LOAD_FAST(d) + op.CLEAR_FAST(d)
+        self.free_register(d)
+        return asm
+
+    def visit_Subscript(self, t):
+        assert isinstance(t.ctx, ast.Load)
+        asm, reg = self.to_register(t.value)
+        asm = asm + self(t.slice) + op.BINARY_SUBSCR(reg) + op.CLEAR_FAST(reg)
+        self.free_register(reg)
+        return asm
+
+    def visit_Slice(self, t):
+        base = self.allocate_register(3)
+        asm = FlatAssembly([])
+        for i, part in enumerate((t.lower, t.upper, t.step)):
+            asm += ((self(part) if part else self.load_const(None))
+                    + op.STORE_FAST(base + i))
+        asm += op.BUILD_SLICE(base)
+        self.free_register(base, 3)
+        return asm
+
+    def visit_Attribute(self, t):
+        assert isinstance(t.ctx, ast.Load)
+        asm, reg = self.to_register(t.value)
+        asm = (asm + op.LOAD_ATTR(reg, self.constants[t.attr],
+                                  self.metaslot(1))
+               + op.CLEAR_FAST(reg))
+        self.free_register(reg)
+        return asm
+
+    def visit_Import(self, t):
+        asm = FlatAssembly([])
+        for alias in t.names:
+            assert alias.asname is None or '.' not in alias.name
+            asm += (op.IMPORT_NAME(self.constants[(alias.name, None, 0)])
+                    + self.store(alias.asname or alias.name.split('.')[0]))
+        return asm
+
+    def visit_ImportFrom(self, t):
+        fromlist = tuple(alias.name for alias in t.names)
+        key = (t.module or '', fromlist, t.level)
+        asm = op.IMPORT_NAME(self.constants[key])
+        reg = self.allocate_register()
+        asm += op.STORE_FAST(reg)
+        for alias in t.names:
+            asm += (op.IMPORT_FROM(reg, self.constants[alias.name])
+                    + self.store(alias.asname or alias.name))
+        asm += op.CLEAR_FAST(reg)
+        self.free_register(reg)
+        return asm
+
+def function_docstring(t):
+    if (t.body and isinstance(t.body[0], ast.Expr)
+            and isinstance(t.body[0].value, ast.Constant)
+            and isinstance(t.body[0].value.value, str)):
+        return t.body[0].value.value
+    return None
+
+
+load, store = ast.Load(), ast.Store()
+
+def Call(fn, args):
+    return ast.Call(fn, args, [])
+
+class Function(ast.AST):
+    _fields = ('name', 'args', 'body')
+
+class Class(ast.AST):
+    _fields = ('name', 'bases', 'body')
+
+CodeGen.dispatch = {(getattr(ast, name[6:], None) or globals()[name[6:]]): method
+                    for name, method in vars(CodeGen).items()
+                    if name.startswith('visit_')}
+
+def rewriter(rewrite):
+    def visit(self, t):
+        return ast.copy_location(rewrite(self, self.generic_visit(t)), t)
+    return visit
+
+class DesugarAndScope(ast.NodeTransformer):
+    # Desugaring and scope collection in one traversal: the rewriters run
+    # as before, and every name definition and use is recorded into the
+    # current Scope as the node passes by, instead of walking the
+    # rewritten tree all over again.
+
+    def __init__(self, t):
+        self.scope = Scope(t, ())
+
+    def visit_Name(self, t):
+        if isinstance(t.ctx, ast.Load):
+            self.scope.uses.add(t.id)
+        else:
+            self.scope.defs.add(t.id)
+        return t
+
+    def visit_Import(self, t):
+        for alias in t.names:
+            self.scope.defs.add(alias.asname or alias.name.split('.')[0])
+        return t
+
+    def visit_ImportFrom(self, t):
+        for alias in t.names:
+            self.scope.defs.add(alias.asname or alias.name)
+        return t
+
+    def subscope(self, t, body, defs):
+        # Traverse body inside a fresh child Scope.
+        parent, self.scope = self.scope, Scope(t, defs)
+        body = [self.visit(stmt) for stmt in body]
+        child, self.scope = self.scope, parent
+        return body, child
+
+    def graft(self, node, child):
+        # CodeGen finds the child scope by the node that lands in the
+        # rewritten tree, so re-key it once that node exists.
+        child.t = node
+        self.scope.children[node] = child
+        return node
+
+    @rewriter
+    def visit_Assert(self, t):
+        self.scope.uses.add('AssertionError')  # used by the rewrite
+        return ast.If(t.test,
+                      [],
+                      [ast.Raise(Call(ast.Name('AssertionError', load),
+                                      [] if t.msg is None else [t.msg]),
+                                 None)])
+
+    def visit_Lambda(self, t):
+        [body], child = self.subscope(t, [t.body],
+                                      [arg.arg for arg in t.args.args])
+        fn = self.graft(Function('<lambda>', t.args, [ast.Return(body)]),
+                        child)
+        return ast.copy_location(fn, t)
+
+    def visit_FunctionDef(self, t):
+        body, child = self.subscope(t, t.body,
+                                    [arg.arg for arg in t.args.args])
+        fn = self.graft(Function(t.name, t.args, body), child)
+        for d in reversed(t.decorator_list):
+            fn = Call(self.visit(d), [fn])
+        self.scope.defs.add(t.name)
+        return ast.copy_location(ast.Assign([ast.Name(t.name, store)], fn),
+                                 t)
+
+    def visit_ClassDef(self, t):
+        bases = [self.visit(base) for base in t.bases]
+        body, child = self.subscope(t, t.body, ())
+        cls = self.graft(Class(t.name, bases, body), child)
+        for d in reversed(t.decorator_list):
+            cls = Call(self.visit(d), [cls])
+        self.scope.defs.add(t.name)
+        return ast.copy_location(ast.Assign([ast.Name(t.name, store)], cls),
+                                 t)
+
+    # Constant folding.  The children are already rewritten when these
+    # run, so folds cascade: 2*3 becomes 6, then 1+6 becomes 7.
+
+    @rewriter
+    def visit_BinOp(self, t):
+        if (type(t.op) in self.fold2 and all(map(numeric_literal,
+                                                 (t.left, t.right)))
+                and safe_to_fold(t.op, t.left.value, t.right.value)):
+            try:
+                value = self.fold2[type(t.op)](t.left.value, t.right.value)
+            except (ArithmeticError, TypeError, ValueError):
+                return t        # leave the error for run time
+            if not isinstance(value, int) or value.bit_length() <= 128:
+                return ast.Constant(value)
+        return t
+
+    @rewriter
+    def visit_UnaryOp(self, t):
+        if type(t.op) in self.fold1 and numeric_literal(t.operand):
+            try:
+                return ast.Constant(self.fold1[type(t.op)](t.operand.value))
+            except TypeError:   # e.g. ~ on a float
+                return t
+        return t
+
+    @rewriter
+    def visit_BoolOp(self, t):
+        if all(isinstance(value, ast.Constant) for value in t.values):
+            stop = isinstance(t.op, ast.Or)  # `or` stops on truth
+            for value in t.values:
+                if bool(value.value) == stop:
+                    break
+            return value
+        return t
+
+    @rewriter
+    def visit_Compare(self, t):
+        if (len(t.ops) == 1 and type(t.ops[0]) in self.fold_cmp
+                and all(map(numeric_literal, (t.left, t.comparators[0])))):
+            try:
+                return ast.Constant(self.fold_cmp[type(t.ops[0])](
+                    t.left.value, t.comparators[0].value))
+            except TypeError:   # e.g. ordering complex numbers
+                return t
+        return t
+
+    fold1 = {ast.UAdd:   operator.pos,
+             ast.USub:   operator.neg,
+             ast.Invert: operator.invert,
+             ast.Not:    operator.not_}
+
+    fold2 = {ast.Pow:      operator.pow,
+             ast.Mult:     operator.mul,
+             ast.Div:      operator.truediv,
+             ast.FloorDiv: operator.floordiv,
+             ast.Mod:      operator.mod,
+             ast.Add:      operator.add,
+             ast.Sub:      operator.sub,
+             ast.LShift:   operator.lshift,
+             ast.RShift:   operator.rshift,
+             ast.BitAnd:   operator.and_,
+             ast.BitXor:   operator.xor,
+             ast.BitOr:    operator.or_}
+
+    fold_cmp = {ast.Eq: operator.eq, ast.NotEq: operator.ne,
+                ast.Lt: operator.lt, ast.LtE: operator.le,
+                ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+def numeric_literal(t):
+    return isinstance(t, ast.Constant) and isinstance(t.value,
+                                                      (int, float, complex))
+
+def safe_to_fold(op, left, right):
+    # Bound the size of an integer result *before* computing it, like
+    # ast_opt.c's safe_power/safe_lshift: 9 ** 9 ** 9 must not hang the
+    # compiler building a number the 128-bit cap will then throw away.
+    if not isinstance(left, int) or not isinstance(right, int):
+        return True
+    if isinstance(op, ast.Pow):
+        return (left == 0 or right <= 0
+                or left.bit_length() * right <= 128)
+    if isinstance(op, ast.LShift):
+        return right < 0 or left.bit_length() + right <= 128
+    if isinstance(op, ast.Mult):
+        return left.bit_length() + right.bit_length() <= 128
+    return True
+
+
+class Scope:
+    # Filled in by DesugarAndScope during the rewrite traversal; analyze
+    # then runs over the finished scope tree.
+    def __init__(self, t, defs):
+        self.t = t
+        self.children = {}
+        self.defs = set(defs)
+        self.uses = set()
+
+    def analyze(self, parent_defs):
+        self.optimized = isinstance(self.t, Function)
+        self.isclass = isinstance(self.t, Class)
+        self.local_defs = self.defs if self.optimized else set()
+        for child in self.children.values():
+            child.analyze(parent_defs | self.local_defs)
+        child_uses = set(v for child in self.children.values()
+                         for v in child.freevars)
+        uses = self.uses | child_uses
+        self.cellvars = tuple(sorted(child_uses & self.local_defs))
+        self.freevars = tuple(sorted(uses & (parent_defs - self.local_defs)))
+        self.derefvars = self.cellvars + self.freevars
+        args = ([arg.arg for arg in self.t.args.args] if self.optimized
+                else [])
+        self.varnames = args + sorted(self.local_defs - set(args))
+
+    def access(self, name):
+        if name in self.derefvars:
+            return 'deref'
+        elif self.optimized:
+            return 'fast' if name in self.local_defs else 'global'
+        else:
+            return 'name'
+
+
+if __name__ == '__main__':
+    load_file(sys.argv[1], '__main__')